@@ -32,12 +32,13 @@ print("🔒 Configuración cargada correctamente. Los secretos están en memoria
 # ============================================================
 try:
     import sklearn
-    import statsmodels
+    import numba
+    import orjson
     import pytz 
     print("✅ Librerías científicas ya instaladas.")
 except ImportError:
     print("⚠️ Instalando dependencias...")
-    %pip install scikit-learn statsmodels pytz
+    %pip install scikit-learn numba orjson pytz
     print("✅ Instalación completada. Reiniciando kernel...")
     dbutils.library.restartPython()
 
@@ -50,9 +51,15 @@ import numpy as np
 import logging
 import requests
 import json
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 import pytz
 from datetime import datetime, timedelta
-from pyspark.sql import functions as F
+from numba import njit
+from scipy.stats import chi2
+from sklearn.ensemble import IsolationForest
+from pyspark.sql.types import StructType, StructField, StringType
 
 # Configurar Fecha de Corte usando la Zona Horaria de la Configuración
 tz = pytz.timezone(config['zona_horaria'])
@@ -63,53 +70,123 @@ logger = logging.getLogger("TFM_Secure")
 
 print(f"📅 Fecha de Análisis (Ayer en {config['zona_horaria']}): {FECHA_CORTE_ANALISIS}")
 
+# Ciclos completos mínimos en el tramo interior para prescindir de la extrapolación de la tendencia.
+# Con menos, cada día de la semana tiene pocos residuos interiores (uno solo con n=14-15, nulo por
+# construcción): la MAD se subestima (o colapsa a cero) y se disparan las falsas alertas
+CICLOS_MIN_INTERIOR = 5
+
+# Núcleo STL+MAD compilado con Numba: tendencia, estacionalidad, residuos y MAD en bucles fusionados.
+# Sin cache=True: las funciones definidas en el notebook no tienen fichero donde guardar la caché.
+@njit
+def _ajuste_lineal(valores, ini, fin):
+    # Recta de mínimos cuadrados sobre valores[ini:fin] con x = posición
+    n = fin - ini
+    x_media = (ini + fin - 1) / 2.0
+    y_media = 0.0
+    for i in range(ini, fin):
+        y_media += valores[i]
+    y_media /= n
+    num = 0.0
+    den = 0.0
+    for i in range(ini, fin):
+        num += (i - x_media) * (valores[i] - y_media)
+        den += (i - x_media) ** 2
+    pendiente = num / den
+    return pendiente, y_media - pendiente * x_media
+
+@njit
+def nucleo_stl_mad(y, periodo, k):
+    # Descomposición aditiva + MAD; devuelve (anómalo, residuo último día, mad).
+    # Series largas: sin extrapolar la tendencia (extrapolate_trend=0), la MAD se calcula sobre los
+    # residuos interiores y el residuo del último día usa la última tendencia con ventana completa.
+    # Series cortas (< CICLOS_MIN_INTERIOR ciclos interiores): tendencia extrapolada linealmente a
+    # los extremos y MAD sobre toda la serie (equivale a seasonal_decompose(extrapolate_trend='freq'))
+    n = y.size
+    m = periodo // 2
+    ini, fin = m, n - m - 1
+    extrapolar = fin + 1 - ini < CICLOS_MIN_INTERIOR * periodo
+    
+    # Tendencia: media móvil centrada con suma acumulada deslizante (solo índices ini..fin)
+    tendencia = np.empty(n)
+    suma = 0.0
+    for i in range(periodo):
+        suma += y[i]
+    tendencia[ini] = suma / periodo
+    for i in range(ini + 1, fin + 1):
+        suma += y[i + m] - y[i - m - 1]
+        tendencia[i] = suma / periodo
+    
+    # Tramo sobre el que se estiman estacionalidad y MAD
+    if extrapolar:
+        # Extremos: extrapolación lineal sobre los 'periodo' puntos definidos más cercanos
+        pendiente, corte = _ajuste_lineal(tendencia, ini, ini + periodo)
+        for i in range(ini):
+            tendencia[i] = pendiente * i + corte
+        pendiente, corte = _ajuste_lineal(tendencia, fin - periodo, fin)
+        for i in range(fin + 1, n):
+            tendencia[i] = pendiente * i + corte
+        desde, hasta = 0, n - 1
+    else:
+        desde, hasta = ini, fin
+    
+    # Estacionalidad: media por posición del ciclo, centrada en cero
+    estacional = np.zeros(periodo)
+    cuenta = np.zeros(periodo)
+    for i in range(desde, hasta + 1):
+        estacional[i % periodo] += y[i] - tendencia[i]
+        cuenta[i % periodo] += 1
+    estacional /= cuenta
+    estacional -= estacional.mean()
+    
+    residuos = np.empty(hasta + 1 - desde)
+    for i in range(desde, hasta + 1):
+        residuos[i - desde] = y[i] - tendencia[i] - estacional[i % periodo]
+    
+    mediana = np.median(residuos)
+    mad = np.median(np.abs(residuos - mediana)) * 1.4826
+    if mad == 0:
+        mad = 1e-6
+    
+    residuo_hoy = y[n - 1] - tendencia[hasta] - estacional[(n - 1) % periodo]
+    es_anomalia = residuo_hoy > mediana + k * mad or residuo_hoy < mediana - k * mad
+    return es_anomalia, residuo_hoy, mad
+
 class SistemaAlertasMarketing:
     def __init__(self, fecha_corte, umbral_mad=3.2, contaminacion_if=0.02):
         self.umbral_mad = umbral_mad
         self.contaminacion_if = contaminacion_if
         self.fecha_objetivo = fecha_corte
-        
-    def detectar_stl_mad(self, df_pandas, metrica):
+    
+    def detectar_stl_mad(self, fechas, valores, metrica):
+        # fechas/valores: arrays ya ordenados por fecha (se ordena una sola vez por dominio)
         try:
-            serie = df_pandas.set_index('fecha')[metrica].sort_index()
-            if serie.empty: return []
+            if len(valores) == 0: return []
             
             # Validación estricta de fecha
-            idx_max = serie.index.max()
-            fecha_ultimo = idx_max.date() if isinstance(idx_max, datetime) else idx_max
+            fecha_max = fechas[-1]
+            fecha_ultimo = fecha_max.date() if isinstance(fecha_max, datetime) else fecha_max
             
             if fecha_ultimo != self.fecha_objetivo:
                 return []
 
-            if len(serie) < 14: return []
+            if len(valores) < 14: return []
             
-            # Importación Lazy para ahorrar memoria si no se usa
-            from statsmodels.tsa.seasonal import seasonal_decompose
+            # Serie constante (p. ej. sin inversión en el periodo): residuos nulos, no puede haber alerta
+            if valores.max() == valores.min(): return []
             
-            res = seasonal_decompose(serie, model='additive', period=7, extrapolate_trend='freq')
-            residuos = res.resid.dropna()
+            es_anomalia, residuo_hoy, mad = nucleo_stl_mad(valores, 7, self.umbral_mad)
+            valor_hoy = valores[-1]
             
-            mediana = np.median(residuos)
-            mad = np.median(np.abs(residuos - mediana)) * 1.4826
-            if mad == 0: mad = 1e-6
-            
-            umbral_sup = mediana + self.umbral_mad * mad
-            umbral_inf = mediana - self.umbral_mad * mad
-            
-            if idx_max in residuos.index:
-                residuo_hoy = residuos.loc[idx_max]
-                valor_hoy = serie.loc[idx_max]
-                
-                if residuo_hoy > umbral_sup or residuo_hoy < umbral_inf:
-                    return [{
-                        'fecha': idx_max.strftime('%Y-%m-%d'),
-                        'metrica': metrica,
-                        'tipo': "Pico Inusual" if residuo_hoy > 0 else "Caída Abrupta",
-                        'valor': float(valor_hoy),
-                        'metodo': 'STL+MAD',
-                        'score': round(abs(residuo_hoy) / mad, 2),
-                        'params': f"MAD={self.umbral_mad}"
-                    }]
+            if es_anomalia:
+                return [{
+                    'fecha': fecha_max.strftime('%Y-%m-%d'),
+                    'metrica': metrica,
+                    'tipo': "Pico Inusual" if residuo_hoy > 0 else "Caída Abrupta",
+                    'valor': str(float(valor_hoy)),
+                    'metodo': 'STL+MAD',
+                    'score': str(round(abs(residuo_hoy) / mad, 2)),
+                    'params': f"MAD={self.umbral_mad}"
+                }]
             return []
         except Exception as e:
             logger.error(f"Error STL {metrica}: {e}")
@@ -119,8 +196,6 @@ class SistemaAlertasMarketing:
         try:
             if df_pandas.empty: return []
             
-            from sklearn.ensemble import IsolationForest
-            
             df_pandas['fecha_dt'] = pd.to_datetime(df_pandas['fecha'])
             df_filtrado = df_pandas[df_pandas['fecha_dt'].dt.date <= self.fecha_objetivo].copy()
             
@@ -134,17 +209,34 @@ class SistemaAlertasMarketing:
             
             if len(df_model) < 20: return []
             
-            iso = IsolationForest(contamination=self.contaminacion_if, random_state=42, n_jobs=-1)
-            df_model['anomaly'] = iso.fit_predict(df_model)
+            # Último día a cero en las tres métricas: datos aún no cargados, no una anomalía
+            if not df_model.iloc[-1].any(): return []
+            
+            if len(df_model) > 500:
+                iso = IsolationForest(contamination=self.contaminacion_if, random_state=42, n_jobs=-1)
+                es_anomalia = iso.fit_predict(df_model)[-1] == -1
+                metodo, score = 'Isolation Forest', 'N/A'
+            else:
+                # Pocas filas: distancia de Mahalanobis robusta (mediana + MAD) en forma cerrada,
+                # mucho más barata que entrenar 100 árboles para ~65 días x 3 métricas
+                X = df_model.to_numpy(dtype=np.float64)
+                mediana = np.median(X, axis=0)
+                mad = np.median(np.abs(X - mediana), axis=0) * 1.4826
+                mad[mad == 0] = 1e-6
+                Z = (X - mediana) / mad
+                inv_cov = np.linalg.pinv(np.cov(Z.T))
+                d2 = float(Z[-1] @ inv_cov @ Z[-1])
+                es_anomalia = d2 > chi2.ppf(1 - self.contaminacion_if, df=len(metricas))
+                metodo, score = 'Mahalanobis Robusta', str(round(d2, 2))
             
-            if df_model.iloc[-1]['anomaly'] == -1:
+            if es_anomalia:
                 return [{
                     'fecha': df_filtrado.iloc[-1]['fecha'].strftime('%Y-%m-%d'),
                     'metrica': 'Multivariante',
                     'tipo': 'Patrón Irregular (Gasto/Tráfico)',
                     'valor': 'N/A',
-                    'metodo': 'Isolation Forest',
-                    'score': 'N/A',
+                    'metodo': metodo,
+                    'score': score,
                     'params': f"Contam={self.contaminacion_if}"
                 }]
             return []
@@ -160,69 +252,75 @@ print("✅ Lógica de negocio inicializada.")
 # ============================================================
 print("🚀 Iniciando ETL...")
 
+# Transferencias Spark <-> pandas vía Arrow (columnar, sin serializar fila a fila)
+spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+# Tras agregar por dominio y día el volumen es pequeño: 200 particiones serían casi todo planificación
+spark.conf.set("spark.sql.shuffle.partitions", "16")
+
 # Mock de diccionario si no existe
 if 'df_diccionario' not in locals():
     print("⚠️ Usando diccionario mock para demo...")
     data_mock = {'AccountID': ['123'], 'Dominios Normalizado': ['test.com']}
     df_diccionario = pd.DataFrame(data_mock)
 
-df_diccionario_spark = spark.createDataFrame(df_diccionario)
-df_diccionario_norm = df_diccionario_spark.select(
-    F.regexp_replace(F.col("AccountID").cast("string"), r"[^0-9]", "").alias("account_id_norm"),
-    F.col("Dominios Normalizado").alias("dominio_normalizado")
-).dropDuplicates(["account_id_norm"])
+# El diccionario es pequeño: se normaliza y deduplica en pandas (sin shuffle en Spark)
+# y llega a Spark como relación local, lista para el BROADCAST de la consulta
+df_diccionario_pd = df_diccionario.dropna(subset=['AccountID'])
+df_diccionario_pd = pd.DataFrame({
+    'account_id_norm': df_diccionario_pd['AccountID'].astype(str).str.replace(r'[^0-9]', '', regex=True),
+    'dominio_normalizado': df_diccionario_pd['Dominios Normalizado']
+}).drop_duplicates('account_id_norm')
+df_diccionario_norm = spark.createDataFrame(df_diccionario_pd)
 
 # Preparamos variables para SQL injection segura
-fecha_sql = FECHA_CORTE_ANALISIS.strftime('%Y-%m-%d')
+# Límites precalculados (fin exclusivo): la columna 'date' se compara sin funciones contra literales,
+# así Catalyst puede podar particiones/ficheros por fecha aunque 'date' sea TIMESTAMP
 dias = config['dias_historico']
+fecha_inicio = (FECHA_CORTE_ANALISIS - timedelta(days=dias)).strftime('%Y-%m-%d')
+fecha_fin = (FECHA_CORTE_ANALISIS + timedelta(days=1)).strftime('%Y-%m-%d')
 
 print(f"📥 Consultando tablas: {config['tabla_ga4']} ...")
 
-# Queries usando f-strings con las variables de CONFIG
-df_ga4 = spark.sql(f"""
-    SELECT REGEXP_REPLACE(CAST(propertyID AS STRING),'[^0-9]','') AS account_id_norm,
-    DATE(date) AS fecha, CAST(SUM(TotalConversions) AS INT) AS leads, CAST(SUM(TotalSessions) AS INT) AS sesiones
-    FROM {config['tabla_ga4']} 
-    WHERE DATE(date) >= DATE_SUB(DATE('{fecha_sql}'), {dias})
-      AND DATE(date) <= DATE('{fecha_sql}')
-    GROUP BY REGEXP_REPLACE(CAST(propertyID AS STRING), '[^0-9]', ''), DATE(date)
-""")
-
-df_facebook = spark.sql(f"""
-    SELECT REGEXP_REPLACE(CAST(account_id AS STRING), '[^0-9]', '') AS account_id_norm,
-    DATE(date) AS fecha, CAST(SUM(spend_gbp) AS INT) AS spend
-    FROM {config['tabla_facebook']}
-    WHERE DATE(date) >= DATE_SUB(DATE('{fecha_sql}'), {dias})
-      AND DATE(date) <= DATE('{fecha_sql}')
-    GROUP BY REGEXP_REPLACE(CAST(account_id AS STRING), '[^0-9]', ''), DATE(date)
-""")
+df_diccionario_norm.createOrReplaceTempView("diccionario_norm")
 
-df_googleads = spark.sql(f"""
-    SELECT REGEXP_REPLACE(CAST(account_id AS STRING), '[^0-9]', '') AS account_id_norm,
-    DATE(date) AS fecha, CAST(SUM(spend_gbp) AS INT) AS spend
-    FROM {config['tabla_google']}
-    WHERE DATE(date) >= DATE_SUB(DATE('{fecha_sql}'), {dias})
-      AND DATE(date) <= DATE('{fecha_sql}')
-    GROUP BY REGEXP_REPLACE(CAST(account_id AS STRING), '[^0-9]', ''), DATE(date)
+# Una sola consulta con las variables de CONFIG: UNION ALL de las tres fuentes (columnas dispersas)
+# y una única agregación por dominio y día, en lugar de tres consultas + dos joins + fillna.
+# Las métricas salen como INT (32 bits) para reducir el volumen que viaja por Arrow hacia el UDF.
+# El ID se normaliza una sola vez por fila en cada escaneo y el diccionario se une una sola vez.
+df_final = spark.sql(f"""
+    SELECT /*+ BROADCAST(d) */ d.dominio_normalizado, f.fecha,
+           CAST(COALESCE(SUM(f.spend), 0) AS INT) AS inversion_total,
+           CAST(COALESCE(SUM(f.leads), 0) AS INT) AS leads_total,
+           CAST(COALESCE(SUM(f.sesiones), 0) AS INT) AS sesiones_total
+    FROM (
+        SELECT REGEXP_REPLACE(CAST(propertyID AS STRING), '[^0-9]', '') AS account_id_norm,
+               DATE(date) AS fecha, NULL AS spend, TotalConversions AS leads, TotalSessions AS sesiones
+        FROM {config['tabla_ga4']}
+        WHERE date >= '{fecha_inicio}' AND date < '{fecha_fin}'
+        
+        UNION ALL
+        
+        SELECT REGEXP_REPLACE(CAST(account_id AS STRING), '[^0-9]', '') AS account_id_norm,
+               DATE(date) AS fecha, spend_gbp AS spend, NULL AS leads, NULL AS sesiones
+        FROM {config['tabla_facebook']}
+        WHERE date >= '{fecha_inicio}' AND date < '{fecha_fin}'
+        
+        UNION ALL
+        
+        SELECT REGEXP_REPLACE(CAST(account_id AS STRING), '[^0-9]', '') AS account_id_norm,
+               DATE(date) AS fecha, spend_gbp AS spend, NULL AS leads, NULL AS sesiones
+        FROM {config['tabla_google']}
+        WHERE date >= '{fecha_inicio}' AND date < '{fecha_fin}'
+    ) f
+    JOIN diccionario_norm d ON f.account_id_norm = d.account_id_norm
+    WHERE d.dominio_normalizado IS NOT NULL
+    GROUP BY d.dominio_normalizado, f.fecha
 """)
 
-# Joins
-df_ga4_enr = df_ga4.join(df_diccionario_norm, "account_id_norm", "left") \
-    .groupBy("dominio_normalizado", "fecha").agg(F.sum("leads").alias("leads"), F.sum("sesiones").alias("sesiones"))
-
-df_inv_total = df_facebook.join(df_diccionario_norm, "account_id_norm", "left").select("dominio_normalizado", "fecha", "spend") \
-    .unionByName(df_googleads.join(df_diccionario_norm, "account_id_norm", "left").select("dominio_normalizado", "fecha", "spend")) \
-    .groupBy("dominio_normalizado", "fecha").agg(F.sum("spend").alias("inversion_total"))
-
-df_final = df_inv_total.join(df_ga4_enr, ["dominio_normalizado", "fecha"], "full") \
-    .fillna(0, subset=["inversion_total", "leads", "sesiones"]) \
-    .withColumnRenamed("leads", "leads_total") \
-    .withColumnRenamed("sesiones", "sesiones_total") \
-    .filter(F.col("dominio_normalizado").isNotNull()) \
-    .orderBy("dominio_normalizado", "fecha")
-
-count = df_final.count()
-print(f"✅ ETL Completado. {count} registros listos.")
+# Particionado por dominio, cada partición contiene grupos completos y applyInPandas no vuelve a barajar.
+# Sin count(): el ETL se ejecuta una sola vez, dentro del job de detección de la Celda 4.
+df_final = df_final.repartition("dominio_normalizado")
+print("✅ ETL preparado.")
 
 # COMMAND ----------
 # ============================================================
@@ -230,12 +328,24 @@ print(f"✅ ETL Completado. {count} registros listos.")
 # ============================================================
 print(f"🧪 Iniciando detección (MAD={config['umbral_mad']}, Contam={config['contaminacion_if']})...")
 
-lista_dominios = [row.dominio_normalizado for row in df_final.select("dominio_normalizado").distinct().collect()]
-resultados_alertas = []
+# Esquema de salida del UDF: 'valor' y 'score' mezclan números y 'N/A', los detectores ya los emiten como texto
+ESQUEMA_ALERTAS = StructType([
+    StructField("dominio", StringType()),
+    StructField("fecha", StringType()),
+    StructField("metrica", StringType()),
+    StructField("tipo", StringType()),
+    StructField("valor", StringType()),
+    StructField("metodo", StringType()),
+    StructField("score", StringType()),
+    StructField("params", StringType())
+])
 
-for dominio in lista_dominios:
-    df_pd = df_final.filter(F.col("dominio_normalizado") == dominio).toPandas()
-    if df_pd.empty: continue
+def detectar_alertas_dominio(df_pd):
+    """Se ejecuta en los executors: recibe todas las filas de un dominio y devuelve sus alertas."""
+    # applyInPandas no garantiza el orden dentro del grupo
+    df_pd = df_pd.sort_values('fecha').reset_index(drop=True)
+    dominio = df_pd['dominio_normalizado'].iloc[0]
+    fechas = df_pd['fecha'].to_numpy()
     
     motor = SistemaAlertasMarketing(
         fecha_corte=FECHA_CORTE_ANALISIS, 
@@ -245,22 +355,25 @@ for dominio in lista_dominios:
     alertas_dom = []
     
     for met in ['inversion_total', 'leads_total', 'sesiones_total']:
-        alertas_dom.extend(motor.detectar_stl_mad(df_pd, met))
+        alertas_dom.extend(motor.detectar_stl_mad(fechas, df_pd[met].to_numpy(dtype=np.float32), met))
     
     alertas_dom.extend(motor.detectar_isolation_forest(df_pd))
     
     for a in alertas_dom:
         a['dominio'] = dominio
-        resultados_alertas.append(a)
+    
+    return pd.DataFrame(alertas_dom, columns=ESQUEMA_ALERTAS.fieldNames())
+
+# Un único job: Spark agrupa por dominio y ejecuta la detección en paralelo en los executors
+df_alertas = df_final.groupBy("dominio_normalizado").applyInPandas(detectar_alertas_dominio, schema=ESQUEMA_ALERTAS)
+filas_alertas = df_alertas.collect()
+resultados_alertas = [fila.asDict() for fila in filas_alertas]
 
 print(f"\n📊 ALERTAS DETECTADAS: {len(resultados_alertas)}")
 
 if resultados_alertas:
-    df_res = pd.DataFrame(resultados_alertas)
-    # Conversión para evitar error PySpark Arrow
-    df_res['valor'] = df_res['valor'].astype(str)
-    df_res['score'] = df_res['score'].astype(str)
-    display(spark.createDataFrame(df_res))
+    # Las filas ya llegan tipadas con ESQUEMA_ALERTAS: sin pasar por pandas ni inferir tipos
+    display(spark.createDataFrame(filas_alertas, schema=ESQUEMA_ALERTAS))
 else:
     print("✅ Sin alertas críticas.")
 
@@ -268,7 +381,12 @@ else:
 # ============================================================
 # CELDA 5: ENVÍO SEGURO (USA URL DE CONFIG)
 # ============================================================
-def enviar_adaptive_card(webhook, alerta):
+# Sesión compartida: reutiliza conexiones TCP/TLS (keep-alive) entre envíos concurrentes
+ENVIOS_PARALELOS = 16
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=ENVIOS_PARALELOS, pool_maxsize=ENVIOS_PARALELOS))
+
+def enviar_adaptive_card(session, webhook, alerta):
     try:
         # Extraer datos seguros
         metrica = alerta.get('metrica', 'N/A')
@@ -315,7 +433,8 @@ def enviar_adaptive_card(webhook, alerta):
             }]
         }
         
-        requests.post(webhook, json=payload).raise_for_status()
+        # orjson (C) serializa la tarjeta mucho más rápido que el json de la librería estándar
+        session.post(webhook, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}).raise_for_status()
         return True
     except Exception as e:
         print(f"Error envío: {e}")
@@ -327,7 +446,8 @@ if resultados_alertas:
         print("❌ ERROR: Configura la URL del Webhook en la Celda 0.")
     else:
         print(f"📤 Enviando {len(resultados_alertas)} alertas...")
-        enviados = sum([enviar_adaptive_card(webhook_safe, a) for a in resultados_alertas])
+        with ThreadPoolExecutor(max_workers=ENVIOS_PARALELOS) as pool:
+            enviados = sum(pool.map(lambda a: enviar_adaptive_card(SESSION, webhook_safe, a), resultados_alertas))
         print(f"✅ Enviados: {enviados}/{len(resultados_alertas)}")
 else:
     print("⚠️ Nada que enviar.")
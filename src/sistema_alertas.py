@@ -1,19 +1,206 @@
 """
 Módulo principal del sistema de alertas por anomalías.
-Implementa los algoritmos STL+MAD e Isolation Forest utilizando librerías científicas reales.
+Implementa los algoritmos STL+MAD (núcleo NumPy compilado con Numba) e Isolation Forest (Scikit-Learn).
 """
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
 import logging
 
 # Importaciones para lógica real de Ciencia de Datos
 try:
-    from statsmodels.tsa.seasonal import seasonal_decompose
     from sklearn.ensemble import IsolationForest
-    from sklearn.impute import SimpleImputer
+    from joblib import parallel_backend
 except ImportError as e:
-    logging.error(f"⚠️ Librerías científicas no encontradas: {e}. Instalar con: pip install scikit-learn statsmodels")
+    logging.error(f"⚠️ Librerías científicas no encontradas: {e}. Instalar con: pip install scikit-learn")
+
+# Hilos para los envíos a Teams (limitados por E/S)
+_ENVIOS_PARALELOS = 8
+
+# Numba es opcional: sin él, el núcleo STL+MAD se ejecuta igualmente como NumPy vectorizado
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda funcion: funcion
+
+@njit(cache=True)
+def _mediana(valores):
+    """
+    Mediana con una única llamada a np.partition (selección O(N), sin ordenar).
+    
+    Args:
+        valores (np.ndarray): Valores sin NaN
+        
+    Returns:
+        float: Mediana de los valores
+    """
+    k = valores.size // 2
+    particion = np.partition(valores, k)
+    if valores.size % 2:
+        return particion[k]
+    # Tras particionar en k, el elemento k-1 ordenado es el máximo de la mitad inferior
+    return 0.5 * (particion[:k].max() + particion[k])
+
+@njit(cache=True)
+def _ajuste_lineal(valores, ini, fin):
+    """
+    Recta de mínimos cuadrados sobre valores[ini:fin] tomando la posición como x.
+    
+    Returns:
+        tuple: (pendiente, ordenada en el origen)
+    """
+    x = np.arange(ini, fin).astype(np.float64)
+    y = valores[ini:fin]
+    x_media = x.mean()
+    y_media = y.mean()
+    pendiente = ((x - x_media) * (y - y_media)).sum() / ((x - x_media) ** 2).sum()
+    return pendiente, y_media - pendiente * x_media
+
+@njit(cache=True, nogil=True)
+def _nucleo_stl_mad(valores, periodo, umbral):
+    """
+    Núcleo fusionado STL+MAD: tendencia, estacionalidad, residuos, MAD, umbral y clasificación.
+    La descomposición equivale a seasonal_decompose(model='additive', extrapolate_trend='freq').
+    
+    Args:
+        valores (np.ndarray): Serie temporal ordenada por fecha
+        periodo (int): Periodo estacional impar (7 = semanal)
+        umbral (float): Número de MADs para considerar un residuo anómalo
+        
+    Returns:
+        tuple: (índices anómalos, es_pico, magnitudes relativas %, scores Z robustos)
+    """
+    y = valores.astype(np.float64)
+    n = y.size
+    m = periodo // 2
+    ini, fin = m, n - m - 1
+    x = np.arange(n).astype(np.float64)
+    
+    # Tendencia: media móvil centrada en O(N) con suma acumulada (una resta y una división por punto)
+    acumulada = np.zeros(n + 1)
+    acumulada[1:] = np.cumsum(y)
+    tendencia = np.empty(n)
+    tendencia[ini:fin + 1] = (acumulada[periodo:] - acumulada[:n + 1 - periodo]) / periodo
+    
+    # Extremos: extrapolación lineal sobre los 'periodo' puntos definidos más cercanos
+    pendiente, corte = _ajuste_lineal(tendencia, ini, ini + periodo)
+    tendencia[:ini] = pendiente * x[:ini] + corte
+    pendiente, corte = _ajuste_lineal(tendencia, fin - periodo, fin)
+    tendencia[fin + 1:] = pendiente * x[fin + 1:] + corte
+    
+    # Estacionalidad: media por posición dentro del ciclo, centrada en cero
+    sin_tendencia = y - tendencia
+    estacional = np.empty(periodo)
+    for i in range(periodo):
+        estacional[i] = sin_tendencia[i::periodo].mean()
+    estacional -= estacional.mean()
+    residuos = sin_tendencia - estacional[np.arange(n) % periodo]
+    
+    # MAD robusto (factor 1.4826 para consistencia con distribución normal)
+    mediana = _mediana(residuos)
+    mad = _mediana(np.abs(residuos - mediana)) * 1.4826
+    if mad == 0:
+        mad = 1e-6 # Evitar división por cero en series muy planas
+    
+    # Umbrales dinámicos k * MAD y clasificación de los seleccionados
+    seleccion = np.flatnonzero((residuos > mediana + umbral * mad) | (residuos < mediana - umbral * mad))
+    residuos_sel = residuos[seleccion]
+    
+    media = y.mean()
+    if media != 0:
+        magnitudes = np.abs(residuos_sel) / media * 100
+    else:
+        magnitudes = np.zeros(seleccion.size)
+    
+    return seleccion, residuos_sel > 0, magnitudes, np.abs(residuos_sel) / mad
+
+def _fechas_seleccionadas(indice, posiciones):
+    """
+    Extrae del índice las fechas de las posiciones seleccionadas, como datetime64[D].
+    
+    Args:
+        indice (pd.Index): Índice de la serie o DataFrame analizado
+        posiciones (np.ndarray): Posiciones de las anomalías
+        
+    Returns:
+        np.ndarray: Fechas en datetime64[D] si el índice es de fechas; si no, los valores del índice sin modificar
+    """
+    valores = indice.to_numpy()[posiciones]
+    if valores.dtype.kind == 'M':
+        return valores.astype('datetime64[D]')
+    return valores
+
+@dataclass
+class AlertBatch:
+    """
+    Lote de alertas en formato columnar: un array de NumPy por campo en lugar de
+    una lista de diccionarios. Los diccionarios solo se materializan al enviar a Teams.
+    """
+    fecha: np.ndarray
+    valor: np.ndarray
+    tipo: np.ndarray
+    metrica: np.ndarray
+    score: np.ndarray
+    magnitud: np.ndarray
+    metodo: np.ndarray
+    
+    @classmethod
+    def vacio(cls):
+        """Lote sin alertas."""
+        return cls(*(np.empty(0) for _ in range(7)))
+    
+    @classmethod
+    def concatenar(cls, lotes):
+        """
+        Une varios lotes (p. ej. uno por métrica) en uno solo.
+        
+        Args:
+            lotes (list): Lista de AlertBatch
+            
+        Returns:
+            AlertBatch: Lote con todas las alertas, en el orden de entrada
+        """
+        lotes = [lote for lote in lotes if len(lote)]
+        if not lotes:
+            return cls.vacio()
+        return cls(
+            fecha=np.concatenate([lote.fecha for lote in lotes]),
+            valor=np.concatenate([lote.valor for lote in lotes]),
+            tipo=np.concatenate([lote.tipo for lote in lotes]),
+            metrica=np.concatenate([lote.metrica for lote in lotes]),
+            score=np.concatenate([lote.score for lote in lotes]),
+            magnitud=np.concatenate([lote.magnitud for lote in lotes]),
+            metodo=np.concatenate([lote.metodo for lote in lotes])
+        )
+    
+    def __len__(self):
+        return len(self.fecha)
+    
+    def to_dicts(self):
+        """
+        Materializa el lote como lista de diccionarios (formato de envío a Teams).
+        
+        Returns:
+            list: Lista de diccionarios con las mismas claves que las alertas STL+MAD
+        """
+        return [
+            {
+                'fecha': fecha,
+                'valor': valor,
+                'tipo': tipo,
+                'metrica': metrica,
+                'magnitud_relativa': magnitud,
+                'metodo': metodo,
+                'score_anomalia': score
+            }
+            for fecha, valor, tipo, metrica, magnitud, metodo, score in zip(
+                self.fecha, self.valor.tolist(), self.tipo.tolist(), self.metrica.tolist(),
+                np.round(self.magnitud, 2).tolist(), self.metodo.tolist(), np.round(self.score, 2).tolist()
+            )
+        ]
 
 class SistemaAlertasMarketing:
     """Sistema automático de detección de anomalías en métricas de marketing."""
@@ -41,21 +228,32 @@ class SistemaAlertasMarketing:
         self.logger.info("📂 Cargando datos de ejemplo (Simulación de Capa Gold)...")
         
         # Generar datos sintéticos para demostración
-        fechas = pd.date_range(
-            start=datetime.now() - timedelta(days=self.ventana_analisis),
-            end=datetime.now(),
-            freq='D'
+        # Fechas como datetime64[D] (8 bytes por día, sin objetos Timestamp)
+        hoy = np.datetime64(datetime.now().date())
+        fechas = np.arange(
+            hoy - np.timedelta64(self.ventana_analisis, 'D'),
+            hoy + np.timedelta64(1, 'D'),
+            dtype='datetime64[D]'
         )
+        n = len(fechas)
+        
+        # Patrón semanal: una sola evaluación de seno, reescalada para cada métrica
+        estacionalidad = np.sin(np.arange(n) * (2 * np.pi / 7))
+        
+        # Generador local (PCG64) en lugar del estado global de np.random
+        rng = np.random.default_rng()
+        
+        # Simular patrón semanal con ruido Poisson; columnas ya en float32 y contiguas
+        sesiones = (rng.poisson(1000, n) + estacionalidad * 200).astype(np.float32)
+        leads = (rng.poisson(50, n) + estacionalidad * 10).astype(np.float32)
+        inversion = rng.normal(800, 100, n).astype(np.float32)
         
         datos = pd.DataFrame({
             'fecha': fechas,
-            # Simular patrón semanal con ruido Poisson
-            'sesiones': np.random.poisson(1000, len(fechas)) + 
-                       np.sin(np.arange(len(fechas)) * 2 * np.pi / 7) * 200,
-            'leads': np.random.poisson(50, len(fechas)) + 
-                    np.sin(np.arange(len(fechas)) * 2 * np.pi / 7) * 10,
-            'inversion': np.random.normal(800, 100, len(fechas))
-        })
+            'sesiones': sesiones,
+            'leads': leads,
+            'inversion': inversion
+        }, copy=False)
         
         # Introducir anomalías artificiales para validar detección
         # 1. Pico en Sesiones (e.g. Bot attack o Viralidad)
@@ -70,14 +268,14 @@ class SistemaAlertasMarketing:
     def detectar_anomalias_stl_mad(self, serie, nombre_metrica):
         """
         Detecta anomalías univariantes usando Descomposición Estacional (STL) + MAD.
-        Utiliza statsmodels para descomponer la serie en Tendencia, Estacionalidad y Residuo.
+        Descompone la serie en Tendencia, Estacionalidad y Residuo con un núcleo compilado (Numba).
         
         Args:
             serie (pd.Series): Serie temporal a analizar (indexada por fecha)
             nombre_metrica (str): Nombre de la métrica para logging
             
         Returns:
-            list: Lista de diccionarios con anomalías detectadas
+            AlertBatch: Lote columnar con las anomalías detectadas
         """
         try:
             self.logger.info(f"🔍 Aplicando STL+MAD a {nombre_metrica}...")
@@ -85,56 +283,29 @@ class SistemaAlertasMarketing:
             # Validación mínima de longitud de datos para STL
             if len(serie) < 14: # Mínimo 2 ciclos semanales
                 self.logger.warning(f"Datos insuficientes para STL en {nombre_metrica}")
-                return []
-
-            # 1. Descomposición Estacional REAL (statsmodels)
-            # period=7 asume estacionalidad semanal típica en marketing
-            # extrapolate_trend='freq' permite calcular residuos en los extremos
-            resultado = seasonal_decompose(serie, model='additive', period=7, extrapolate_trend='freq')
-            
-            residuos = resultado.resid
-            
-            # 2. Calcular MAD (Median Absolute Deviation) robusto
-            # Factor 1.4826 para consistencia con distribución normal
-            mediana_residuo = np.median(residuos)
-            mad = np.median(np.abs(residuos - mediana_residuo)) * 1.4826
-            
-            if mad == 0: 
-                mad = 1e-6 # Evitar división por cero en series muy planas
-
-            # 3. Definir umbrales dinámicos basados en k * MAD
-            umbral_superior = mediana_residuo + self.umbral_mad * mad
-            umbral_inferior = mediana_residuo - self.umbral_mad * mad
-            
-            # 4. Detectar y estructurar anomalías
-            anomalias = []
-            for fecha, valor, residuo in zip(serie.index, serie.values, residuos):
-                if residuo > umbral_superior or residuo < umbral_inferior:
-                    tipo = "pico" if residuo > 0 else "caida"
-                    
-                    # Calcular magnitud relativa para contexto de negocio
-                    media_serie = np.mean(serie)
-                    magnitud = abs(residuo) / media_serie * 100 if media_serie != 0 else 0
-                    
-                    # Score Z robusto
-                    score = abs(residuo) / mad
+                return AlertBatch.vacio()
 
-                    anomalias.append({
-                        'fecha': fecha,
-                        'valor': valor,
-                        'tipo': tipo,
-                        'metrica': nombre_metrica,
-                        'magnitud_relativa': round(magnitud, 2),
-                        'metodo': 'STL+MAD (Statsmodels)',
-                        'score_anomalia': round(score, 2)
-                    })
+            # Descomposición (periodo 7 = estacionalidad semanal típica en marketing), MAD y
+            # umbrales k * MAD en un único núcleo compilado: una sola pasada sobre la serie
+            valores = serie.to_numpy()
+            seleccion, es_pico, magnitudes, scores = _nucleo_stl_mad(valores, 7, self.umbral_mad)
+            n_anomalias = seleccion.size
+            anomalias = AlertBatch(
+                fecha=_fechas_seleccionadas(serie.index, seleccion),
+                valor=valores[seleccion],
+                tipo=np.where(es_pico, "pico", "caida"),
+                metrica=np.full(n_anomalias, nombre_metrica),
+                score=scores,
+                magnitud=magnitudes,
+                metodo=np.full(n_anomalias, 'STL+MAD')
+            )
             
             self.logger.info(f"✅ STL+MAD detectó {len(anomalias)} anomalías en {nombre_metrica}")
             return anomalias
             
         except Exception as e:
             self.logger.error(f"❌ Error en STL+MAD para {nombre_metrica}: {str(e)}")
-            return []
+            return AlertBatch.vacio()
     
     def detectar_anomalias_isolation_forest(self, datos):
         """
@@ -157,8 +328,9 @@ class SistemaAlertasMarketing:
             
             # Imputación de nulos (Isolation Forest no soporta NaNs nativamente)
             # Estrategia: Rellenar con 0 asumiendo ausencia de actividad
-            imputer = SimpleImputer(strategy='constant', fill_value=0)
-            datos_array = imputer.fit_transform(datos_limpios)
+            # float32 contiguo: es el tipo que usan internamente los árboles de sklearn,
+            # así se evita una copia extra y se reduce a la mitad la memoria por worker
+            datos_array = np.ascontiguousarray(datos_limpios.fillna(0).to_numpy(dtype=np.float32))
             
             # Validación de volumen mínimo
             if len(datos_limpios) < 10:
@@ -167,42 +339,55 @@ class SistemaAlertasMarketing:
             
             # 1. Configuración del Modelo
             # n_jobs=-1 utiliza todos los cores disponibles (paralelización)
+            # contamination='auto': el umbral por contaminación se calcula abajo sobre los mismos
+            # scores, evitando que fit() puntúe de nuevo todo el conjunto solo para fijar offset_
             iso_forest = IsolationForest(
-                contamination=self.contaminacion_if,
+                contamination='auto',
                 n_estimators=100,
                 random_state=42, # Semilla fija para reproducibilidad
                 n_jobs=-1
             )
             
-            # 2. Entrenamiento y Predicción
-            iso_forest.fit(datos_array)
+            # 2. Entrenamiento y Scoring
+            # Backend de hilos: los árboles se recorren en paralelo sin copiar los datos a otros procesos
+            with parallel_backend("threading", n_jobs=-1):
+                iso_forest.fit(datos_array)
+                
+                # score_samples: menor = más anómalo. Invertimos para que mayor valor signifique mayor anomalía
+                scores_anomalia = -iso_forest.score_samples(datos_array)
             
-            # decision_function: score negativo = anómalo, positivo = normal
-            # Invertimos para que mayor valor signifique mayor anomalía
-            scores_raw = iso_forest.decision_function(datos_array)
-            scores_normalizados = -scores_raw
+            # Umbral automático basado en la contaminación definida: percentil (1 - contaminación)
+            # con la misma interpolación lineal que np.percentile (la que usa sklearn para su offset),
+            # seleccionando los dos estadísticos de orden vecinos con una única np.partition (O(N))
+            n = len(scores_anomalia)
+            posicion = (1 - self.contaminacion_if) * (n - 1)
+            inferior = int(posicion)
+            superior = min(inferior + 1, n - 1)
+            particion = np.partition(scores_anomalia, [inferior, superior])
+            umbral = particion[inferior] + (posicion - inferior) * (particion[superior] - particion[inferior])
+            indices_anomalias = np.flatnonzero(scores_anomalia > umbral)
             
-            # Umbral automático basado en la contaminación definida
-            # predict devuelve -1 para outliers y 1 para inliers
-            predicciones = iso_forest.predict(datos_array)
-            indices_anomalias = np.where(predicciones == -1)[0]
+            # Score relativo al umbral (equivale a -decision_function): positivo = anómalo
+            scores_normalizados = scores_anomalia - umbral
             
-            anomalias = []
-            for idx in indices_anomalias:
-                fecha = datos_limpios.index[idx]
-                score = scores_normalizados[idx]
-                
-                # Reportamos valores contextuales para el dashboard
-                valores_contexto = datos_limpios.iloc[idx].to_dict()
-                
-                anomalias.append({
+            # Fechas y valores contextuales de las filas seleccionadas se extraen de una vez
+            # (sin iloc ni to_dict por fila); los valores se reportan para el dashboard
+            fechas = _fechas_seleccionadas(datos_limpios.index, indices_anomalias)
+            valores_contexto = datos_limpios.to_numpy()[indices_anomalias].tolist()
+            
+            anomalias = [
+                {
                     'fecha': fecha,
                     'score_anomalia': round(score, 4),
                     'tipo': 'patron_multivariante',
                     'metricas_afectadas': metricas, # IF es agnóstico a la métrica individual
                     'metodo': 'IsolationForest (Sklearn)',
-                    'valores': valores_contexto
-                })
+                    'valores': dict(zip(metricas, valores))
+                }
+                for fecha, score, valores in zip(
+                    fechas, scores_normalizados[indices_anomalias].tolist(), valores_contexto
+                )
+            ]
             
             self.logger.info(f"✅ Isolation Forest detectó {len(anomalias)} anomalías multivariantes")
             return anomalias
@@ -240,33 +425,41 @@ class SistemaAlertasMarketing:
         datos = self.cargar_datos_ejemplo()
         
         # 2. Detección Univariante (STL+MAD)
-        alertas_stl = []
-        for metrica in ['sesiones', 'leads', 'inversion']:
-            serie = datos.set_index('fecha')[metrica]
-            alertas_metrica = self.detectar_anomalias_stl_mad(serie, metrica)
-            alertas_stl.extend(alertas_metrica)
-        
-        # 3. Detección Multivariante (Isolation Forest)
+        # Las métricas se procesan en paralelo: el núcleo compilado libera el GIL (nogil)
+        metricas = ['sesiones', 'leads', 'inversion']
         datos_indexados = datos.set_index('fecha')
-        alertas_if = self.detectar_anomalias_isolation_forest(datos_indexados)
+        with ThreadPoolExecutor(max_workers=len(metricas)) as ejecutor:
+            resultados_stl = list(ejecutor.map(
+                lambda metrica: self.detectar_anomalias_stl_mad(datos_indexados[metrica], metrica),
+                metricas
+            ))
+        alertas_stl = AlertBatch.concatenar(resultados_stl)
         
-        # 4. Consolidación y Envío
-        alertas_totales = alertas_stl + alertas_if
-        
-        # Filtrar alertas duplicadas o priorizar (lógica de negocio simple)
-        # Aquí enviamos todas para trazabilidad
-        for alerta in alertas_totales:
-            self.enviar_alerta_teams(alerta)
+        # 3. Detección Multivariante (Isolation Forest), sobre el mismo índice por fecha
+        alertas_if = self.detectar_anomalias_isolation_forest(datos_indexados)
         
-        # 5. Generar métricas de ejecución para logs
+        # 4. Generar métricas de ejecución para logs
         resultados = {
             'total_dominios': 1, 
-            'total_alertas': len(alertas_totales),
+            'total_alertas': len(alertas_stl) + len(alertas_if),
             'alertas_stl': len(alertas_stl),
             'alertas_if': len(alertas_if),
             'alertas_faltantes': 0, # Implementar check de fechas vs calendario
             'fecha_ejecucion': datetime.now().isoformat()
         }
         
+        # 5. Consolidación y Envío: sin anomalías no hay nada que enviar
+        if not resultados['total_alertas']:
+            self.logger.info("✅ Sin anomalías detectadas: no se envían alertas")
+            return resultados
+        
+        # Las alertas STL se mantienen columnares hasta aquí; solo se pasan a diccionarios para Teams
+        alertas_totales = alertas_stl.to_dicts() + alertas_if
+        
+        # Filtrar alertas duplicadas o priorizar (lógica de negocio simple)
+        # Aquí enviamos todas para trazabilidad; los envíos (limitados por E/S) se reparten en un pool de hilos
+        with ThreadPoolExecutor(max_workers=_ENVIOS_PARALELOS) as ejecutor:
+            list(ejecutor.map(self.enviar_alerta_teams, alertas_totales))
+        
         self.logger.info("🎉 Pipeline completado exitosamente")
         return resultados
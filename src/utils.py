@@ -3,9 +3,22 @@ Utilidades auxiliares para el sistema de alertas.
 """
 import json
 import yaml
+import numpy as np
 from datetime import datetime
 import logging
 
+# orjson es opcional: si no está instalado se serializa con json de la librería estándar
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Cargador YAML en C (libyaml) si PyYAML se compiló con él; si no, el de Python puro
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 def cargar_configuracion(ruta_archivo='config/parameters.yaml'):
     """
     Carga la configuración desde archivo YAML.
@@ -18,7 +31,7 @@ def cargar_configuracion(ruta_archivo='config/parameters.yaml'):
     """
     try:
         with open(ruta_archivo, 'r') as archivo:
-            config = yaml.safe_load(archivo)
+            config = yaml.load(archivo, Loader=SafeLoader)
         logging.info("✅ Configuración cargada exitosamente")
         return config
     except Exception as e:
@@ -34,8 +47,14 @@ def guardar_resultados(resultados, ruta_archivo='resultados_ejecucion.json'):
         ruta_archivo (str): Ruta donde guardar los resultados
     """
     try:
-        with open(ruta_archivo, 'w') as archivo:
-            json.dump(resultados, archivo, indent=2, default=str)
+        if orjson is not None:
+            # Las fechas son naive en hora local: no se marcan como UTC (OPT_NAIVE_UTC)
+            opciones = orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            with open(ruta_archivo, 'wb') as archivo:
+                archivo.write(orjson.dumps(resultados, default=str, option=opciones))
+        else:
+            with open(ruta_archivo, 'w') as archivo:
+                json.dump(resultados, archivo, indent=2, default=str)
         logging.info(f"💾 Resultados guardados en {ruta_archivo}")
     except Exception as e:
         logging.error(f"❌ Error guardando resultados: {e}")
@@ -63,7 +82,7 @@ def formatear_alerta_teams(alerta):
                 "activityTitle": f"{emoji} ALERTA - {alerta['tipo'].upper()} DETECTADA",
                 "facts": [
                     {"name": "Métrica:", "value": alerta['metrica']},
-                    {"name": "Fecha:", "value": alerta['fecha'].strftime("%Y-%m-%d")},
+                    {"name": "Fecha:", "value": np.datetime_as_string(np.datetime64(alerta['fecha'], 'D'))},
                     {"name": "Magnitud:", "value": f"{alerta['magnitud_relativa']}%"},
                     {"name": "Método:", "value": alerta['metodo']}
                 ]
@@ -81,11 +100,70 @@ def formatear_alerta_teams(alerta):
                 "facts": [
                     {"name": "Score:", "value": f"{alerta['score_anomalia']}"},
                     {"name": "Métricas:", "value": ", ".join(alerta['metricas_afectadas'])},
-                    {"name": "Fecha:", "value": alerta['fecha'].strftime("%Y-%m-%d")}
+                    {"name": "Fecha:", "value": np.datetime_as_string(np.datetime64(alerta['fecha'], 'D'))}
                 ]
             }]
         }
 
+def formatear_alertas_teams_bulk(alertas):
+    """
+    Formatea un lote de alertas para Microsoft Teams.
+    Las alertas se separan por método una sola vez; cada grupo se construye con una
+    comprensión de listas y sus fechas se convierten a texto en una única llamada vectorizada.
+    
+    Args:
+        alertas (list): Alertas a formatear (STL+MAD y/o Isolation Forest)
+        
+    Returns:
+        list: Mensajes formateados para Teams: primero los STL+MAD y después los multivariantes
+    """
+    alertas_stl = [alerta for alerta in alertas if alerta['metodo'] == 'STL+MAD']
+    alertas_multivariantes = [alerta for alerta in alertas if alerta['metodo'] != 'STL+MAD']
+    
+    fechas_stl = np.datetime_as_string(np.array([alerta['fecha'] for alerta in alertas_stl], dtype='datetime64[D]'))
+    mensajes_stl = [
+        {
+            "@type": "MessageCard",
+            "@context": "http://schema.org/extensions",
+            "themeColor": "FFA500" if alerta['tipo'] == 'pico' else "008000",
+            "summary": f"Alerta - {alerta['tipo']} - {alerta['metrica']}",
+            "sections": [{
+                "activityTitle": f"{'📈' if alerta['tipo'] == 'pico' else '📉'} ALERTA - {alerta['tipo'].upper()} DETECTADA",
+                "facts": [
+                    {"name": "Métrica:", "value": alerta['metrica']},
+                    {"name": "Fecha:", "value": fecha},
+                    {"name": "Magnitud:", "value": f"{alerta['magnitud_relativa']}%"},
+                    {"name": "Método:", "value": alerta['metodo']}
+                ]
+            }]
+        }
+        for alerta, fecha in zip(alertas_stl, fechas_stl.tolist())
+    ]
+    
+    # Isolation Forest
+    fechas_multivariantes = np.datetime_as_string(
+        np.array([alerta['fecha'] for alerta in alertas_multivariantes], dtype='datetime64[D]')
+    )
+    mensajes_multivariantes = [
+        {
+            "@type": "MessageCard",
+            "@context": "http://schema.org/extensions",
+            "themeColor": "FF0000",
+            "summary": "Alerta - Patrón Multivariante",
+            "sections": [{
+                "activityTitle": "🤖 ALERTA - PATRÓN MULTIVARIANTE",
+                "facts": [
+                    {"name": "Score:", "value": f"{alerta['score_anomalia']}"},
+                    {"name": "Métricas:", "value": ", ".join(alerta['metricas_afectadas'])},
+                    {"name": "Fecha:", "value": fecha}
+                ]
+            }]
+        }
+        for alerta, fecha in zip(alertas_multivariantes, fechas_multivariantes.tolist())
+    ]
+    
+    return mensajes_stl + mensajes_multivariantes
+
 def validar_datos(dataframe, metricas_requeridas):
     """
     Valida que el DataFrame tenga las columnas requeridas.
@@ -98,7 +176,8 @@ def validar_datos(dataframe, metricas_requeridas):
         bool: True si los datos son válidos
     """
     try:
-        columnas_faltantes = [col for col in metricas_requeridas if col not in dataframe.columns]
+        columnas = set(dataframe.columns)
+        columnas_faltantes = [col for col in metricas_requeridas if col not in columnas]
         if columnas_faltantes:
             logging.error(f"❌ Columnas faltantes: {columnas_faltantes}")
             return False
@@ -108,7 +187,7 @@ def validar_datos(dataframe, metricas_requeridas):
             return False
         
         # Verificar que no haya fechas duplicadas
-        if dataframe['fecha'].duplicated().any():
+        if not dataframe['fecha'].is_unique:
             logging.warning("⚠️ Fechas duplicadas detectadas")
             
         logging.info("✅ Validación de datos exitosa")
@@ -0,0 +1,66 @@
+"""
+Pruebas de regresión del núcleo STL+MAD del notebook de Databricks.
+El núcleo se extrae del código fuente del notebook (no es importable fuera de Databricks).
+"""
+import os
+import unittest
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda funcion: funcion
+
+RUTA_NOTEBOOK = os.path.join(os.path.dirname(__file__), '..', 'src', 'Sistema de alertas_databricks.py')
+
+def cargar_nucleo():
+    """Ejecuta el bloque del núcleo STL+MAD del notebook y devuelve la función nucleo_stl_mad."""
+    with open(RUTA_NOTEBOOK, encoding='utf-8') as archivo:
+        fuente = archivo.read()
+    inicio = fuente.index('CICLOS_MIN_INTERIOR = ')
+    fin = fuente.index('class SistemaAlertasMarketing')
+    espacio = {'np': np, 'njit': njit}
+    exec(fuente[inicio:fin], espacio)
+    return espacio['nucleo_stl_mad']
+
+def serie_ruido(rng, n):
+    """Ruido Poisson con patrón semanal y fase aleatoria: no contiene anomalías."""
+    x = np.arange(n)
+    fase = rng.integers(7)
+    return (rng.poisson(100, n) + 20 * np.sin(2 * np.pi * (x + fase) / 7)).astype(np.float64)
+
+class TestNucleoStlMad(unittest.TestCase):
+    UMBRAL = 3.5
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nucleo = staticmethod(cargar_nucleo())
+
+    def test_series_cortas_sin_falsas_alertas(self):
+        # Con el guard mínimo de 14 filas, las series cortas no deben disparar alertas sobre ruido
+        rng = np.random.default_rng(0)
+        for n in range(14, 41):
+            alertas = [self.nucleo(serie_ruido(rng, n), 7, self.UMBRAL)[0] for _ in range(300)]
+            self.assertLessEqual(np.mean(alertas), 0.06, f"Tasa de falsas alertas excesiva con n={n}")
+
+    def test_mad_positiva_en_series_cortas(self):
+        rng = np.random.default_rng(1)
+        for n in (14, 15, 16):
+            _, _, mad = self.nucleo(serie_ruido(rng, n), 7, self.UMBRAL)
+            self.assertGreater(mad, 1e-6)
+
+    def test_pico_ultimo_dia_detectado(self):
+        rng = np.random.default_rng(2)
+        for n in (14, 20, 41, 65):
+            serie = serie_ruido(rng, n)
+            serie[-1] *= 5
+            es_anomalia, residuo_hoy, _ = self.nucleo(serie, 7, self.UMBRAL)
+            self.assertTrue(es_anomalia, f"Pico no detectado con n={n}")
+            self.assertGreater(residuo_hoy, 0)
+
+if __name__ == '__main__':
+    unittest.main()